@@ -17,7 +17,7 @@ import copy
 import json
 import logging
 import random
-from functools import cmp_to_key, partial
+from functools import cmp_to_key, partial, reduce
 
 import immutables
 
@@ -87,6 +87,9 @@ class DialogueStateRule:
     logger = mod_logger.getChild("DialogueStateRule")
     """Class logger."""
 
+    _entity_type_bits = {}
+    """Bit positions assigned to the entity types referenced by any rule."""
+
     def __init__(self, dialogue_state, **kwargs):
         """Initializes a dialogue state rule.
 
@@ -149,12 +152,14 @@ class DialogueStateRule:
         self.default = resolved.get("default", False)
         entities = resolved.get("has_entities", None)
         self.entity_types = None
+        self.entity_mask = 0
         if entities is not None:
             for entity in entities:
                 if not isinstance(entity, str):
                     msg = "Invalid entity specification for dialogue state rule: {!r}"
                     raise ValueError(msg.format(entities))
             self.entity_types = frozenset(entities)
+            self.entity_mask = self.get_entity_mask(self.entity_types, register=True)
 
         if self.targeted_only and any([self.domain, self.intent, self.entity_types]):
             raise ValueError(
@@ -170,11 +175,35 @@ class DialogueStateRule:
                 "domain, intent, has_entity, and targeted_only must be omitted"
             )
 
-    def apply(self, request):
+    @classmethod
+    def get_entity_mask(cls, entity_types, register=False):
+        """Returns a bitmask with one bit set for each of the given entity types.
+
+        Args:
+            entity_types (iterable): The entity types.
+            register (bool): Whether to assign bits to entity types which have none yet. Types
+                without a bit are not referenced by any rule, so they are otherwise ignored.
+
+        Returns:
+            (int): The entity type bitmask.
+        """
+        mask = 0
+        for entity_type in entity_types:
+            bit = cls._entity_type_bits.get(entity_type)
+            if bit is None:
+                if not register:
+                    continue
+                bit = cls._entity_type_bits[entity_type] = len(cls._entity_type_bits)
+            mask |= 1 << bit
+        return mask
+
+    def apply(self, request, entity_mask=None):
         """Applies the dialogue state rule to the given context.
 
         Args:
             request (Request): A request object.
+            entity_mask (int, optional): The bitmask of the request's entity types, as returned
+                by get_entity_mask. Computed from the request when omitted.
 
         Returns:
             (bool): Whether or not the context matches.
@@ -195,12 +224,11 @@ class DialogueStateRule:
 
         # check expected entity types are present
         if self.entity_types is not None:
-            # TODO cache entity types
-            entity_types = set()
-            for entity in request.entities:
-                entity_types.add(entity["type"])
-
-            if len(self.entity_types & entity_types) < len(self.entity_types):
+            if entity_mask is None:
+                entity_mask = self.get_entity_mask(
+                    entity["type"] for entity in request.entities
+                )
+            if entity_mask & self.entity_mask != self.entity_mask:
                 return False
 
         return True
@@ -273,6 +301,8 @@ class DialogueManager:
 
         self.handler_map = {}
         self.middlewares = []
+        # The handlers of the dialogue states wrapped in the middleware, by dialogue state
+        self._handler_chains = {}
         self.rules = []
         self.responder_class = responder_class or DialogueResponder
         self.default_rule = None
@@ -318,6 +348,7 @@ class DialogueManager:
             raise TypeError(msg.format(middleware.__name__))
 
         self.middlewares.append(middleware)
+        self._handler_chains = {}
 
     def add_dialogue_rule(self, name, handler, **kwargs):
         """Adds a dialogue state rule for the dialogue manager.
@@ -504,13 +535,17 @@ class DialogueManager:
 
     def _get_dialogue_state(self, request, target_dialogue_state=None):
         dialogue_state = None
+        # Compute the entity types of the request once for all the rules
+        entity_mask = DialogueStateRule.get_entity_mask(
+            entity["type"] for entity in request.entities
+        )
         for rule in self.rules:
             if target_dialogue_state:
                 if target_dialogue_state == rule.dialogue_state:
                     dialogue_state = rule.dialogue_state
                     break
             else:
-                if rule.apply(request):
+                if rule.apply(request, entity_mask):
                     dialogue_state = rule.dialogue_state
                     break
         if dialogue_state is None:
@@ -522,17 +557,28 @@ class DialogueManager:
         return dialogue_state
 
     def _get_dialogue_handler(self, dialogue_state):
+        try:
+            return self._handler_chains[dialogue_state]
+        except KeyError:
+            pass
+
         handler = (
             self.handler_map[dialogue_state]
             if dialogue_state
             else self._default_handler
         )
-
-        for m in reversed(self.middlewares):
-            handler = partial(m, handler=handler)
-
+        # Wrap the handler in the middleware once, with the first middleware registered outermost
+        handler = reduce(
+            lambda inner, m: partial(m, handler=inner),
+            reversed(self._get_middlewares()),
+            handler,
+        )
+        self._handler_chains[dialogue_state] = handler
         return handler
 
+    def _get_middlewares(self):
+        return self.middlewares
+
     def _create_responder(self):
         return self.responder_class(slots={})
 
@@ -681,22 +727,11 @@ class DialogueFlow(DialogueManager):
 
         return {"dialogue_state": dialogue_state, "directives": responder.directives}
 
-    def _get_dialogue_handler(self, dialogue_state):
-        handler = (
-            self.handler_map[dialogue_state]
-            if dialogue_state
-            else self._default_handler
-        )
-
+    def _get_middlewares(self):
         try:
-            middlewares = self.middlewares
+            return self.middlewares
         except AttributeError:
-            middlewares = getattr(self, "middleware", tuple())
-
-        for m in reversed(middlewares):
-            handler = partial(m, handler=handler)
-
-        return handler
+            return getattr(self, "middleware", tuple())
 
 
 class AutoEntityFilling:
@@ -208,6 +208,20 @@ class TaggerModel(Model):
         """
         return param_grid
 
+    def _get_cv_estimator_and_params(self, model_class, param_grid):
+        param_grid = self._clean_params(model_class, param_grid)
+        # Start from the parameters of the set up model, which carry the settings derived from the
+        # model settings, such as the MEMM's L1 feature selection
+        params = self._clf.get_params()
+        if params.get("l1_feature_selection") and "penalty" in param_grid:
+            logger.info(
+                "Ignoring the penalty grid, the 'l1' feature selector requires an L1 penalty"
+            )
+            param_grid = {
+                name: values for name, values in param_grid.items() if name != "penalty"
+            }
+        return model_class(**params), param_grid
+
     def predict(self, examples, dynamic_resource=None):
         """
         Args:
@@ -14,23 +14,102 @@
 """
 This module contains the Memm entity recognizer.
 """
+import itertools
 import logging
+import marshal
+import math
+import os
+import tempfile
 
 import numpy as np
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.feature_selection import SelectFromModel, SelectPercentile
+import scipy.sparse as sp
+from sklearn.externals import joblib
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_selection import SelectPercentile
 from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import LabelEncoder as SKLabelEncoder
 from sklearn.preprocessing import MaxAbsScaler, StandardScaler
 
+from ..helpers import ENABLE_STEMMING, get_feature_extractor
 from .taggers import START_TAG, Tagger, extract_sequence_features
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 logger = logging.getLogger(__name__)
 
 
-class MemmModel(Tagger):
+def _extract_example_features(example, config, resources):
+    """Extracts feature dicts for each token in an example. Defined at the module level so that it
+    can be dispatched to joblib worker processes.
+    """
+    return extract_sequence_features(
+        example, config.example_type, config.features, resources
+    )
+
+
+def _extract_batch_features(examples, config, resources, feat_vectorizer):
+    """Extracts and hashes the token features of a batch of examples, so that joblib workers send
+    back one compact sparse matrix instead of a feature dict per token.
+
+    Returns:
+        (tuple): tuple containing:
+
+            * (scipy.sparse.csr_matrix): The hashed features of every token in the batch.
+            * (list of int): The number of tokens in each example.
+    """
+    features_by_example = [
+        _extract_example_features(example, config, resources) for example in examples
+    ]
+    X = feat_vectorizer.transform(itertools.chain.from_iterable(features_by_example))
+    return X, [len(features_by_segment) for features_by_segment in features_by_example]
+
+
+def _decode(scores, prev_tag_scores, start_tag_id):
+    """Greedily decodes the tags of a sequence from left to right.
+
+    Args:
+        scores (numpy.ndarray): The class scores of each token without the previous tag, of \
+            shape (n_tokens, n_classes).
+        prev_tag_scores (numpy.ndarray): The scores added by each previous tag, of shape \
+            (n_classes, n_classes + 1).
+        start_tag_id (int): The column of prev_tag_scores for the start tag.
+
+    Returns:
+        (numpy.ndarray): The encoded tag of each token.
+    """
+    tag_ids = np.empty(scores.shape[0], dtype=np.int64)
+    prev_tag_id = start_tag_id
+    for idx in range(scores.shape[0]):
+        prev_tag_id = np.argmax(scores[idx] + prev_tag_scores[:, prev_tag_id])
+        tag_ids[idx] = prev_tag_id
+    return tag_ids
+
+
+if njit is not None:
+    _decode = njit(cache=True)(_decode)
+
+
+class MemmModel(Tagger):  # pylint: disable=too-many-instance-attributes
     """A maximum-entropy Markov model."""
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Models pickled before the class labels were cached
+        if "_class_labels" not in state and hasattr(
+            getattr(self, "class_encoder", None), "classes_"
+        ):
+            self._set_class_labels()
+
+    def _set_class_labels(self):
+        """Caches the fitted class labels, so that encoded tags are decoded by indexing instead of
+        calling the label encoder. The start tag is encoded as the id after the last class.
+        """
+        self._class_labels = np.asarray(self.class_encoder.classes_)
+        self._start_tag_id = len(self._class_labels)
+
     @staticmethod
     def _predict_proba(X):
         del X
@@ -42,16 +121,39 @@ class MemmModel(Tagger):
         pass
 
     def fit(self, X, y):
+        # LogisticRegression's solvers all consume CSR, so make sure no other sparse layout
+        # reaches them and forces a conversion inside fit
+        if sp.issparse(X):
+            X = X.tocsr()
         self._clf.fit(X, y)
+        self._prev_tag_scores = None
         return self
 
     def set_params(self, **parameters):
+        # L1 feature selection is a parameter so that the copies of the model made for
+        # cross-validation, which only go through __init__ and set_params, keep it
+        self._l1_feature_selection = parameters.pop(
+            "l1_feature_selection", getattr(self, "_l1_feature_selection", False)
+        )
         self._clf = LogisticRegression()
         self._clf.set_params(**parameters)
+        if self._l1_feature_selection:
+            if parameters.get("penalty", "l1") != "l1":
+                logger.warning(
+                    "Ignoring penalty %r, the 'l1' feature selector requires an L1 penalty",
+                    parameters["penalty"],
+                )
+            self._clf.set_params(penalty="l1")
+            # Only these solvers support an L1 penalty
+            if self._clf.solver not in ("liblinear", "saga"):
+                self._clf.set_params(solver="liblinear")
         return self
 
     def get_params(self, deep=True):
-        return self._clf.get_params()
+        params = self._clf.get_params()
+        if getattr(self, "_l1_feature_selection", False):
+            params["l1_feature_selection"] = True
+        return params
 
     def predict(self, X, dynamic_resource=None):
         return self._clf.predict(X)
@@ -69,9 +171,7 @@ class MemmModel(Tagger):
         Returns:
             (list[dict]): Features.
         """
-        return extract_sequence_features(
-            example, config.example_type, config.features, resources
-        )
+        return _extract_example_features(example, config, resources)
 
     def extract_features(self, examples, config, resources, y=None, fit=True):
         """Transforms a list of examples into a feature matrix. Use extract_and_predict if you are
@@ -90,26 +190,159 @@ class MemmModel(Tagger):
                 * (numpy.matrix): The feature matrix.
                 * (numpy.array): The group labels for examples.
         """
-        groups = []
-        X = []
-        y_flat = [tag for example in y for tag in example]
-        y_offset = 0
-        for i, example in enumerate(examples):
-            features_by_segment = self.extract_example_features(
-                example, config, resources
+        if getattr(self, "_feature_cache_dir", None):
+            X, segment_counts = self._extract_cached_features(
+                examples, config, resources
             )
-            X.extend(features_by_segment)
-            groups.extend([i for _ in features_by_segment])
-            for j, segment in enumerate(features_by_segment):
-                if j == 0:
-                    segment["prev_tag"] = START_TAG
-                elif fit:
-                    segment["prev_tag"] = y_flat[y_offset + j - 1]
-
-            y_offset += len(features_by_segment)
-        X, y = self._preprocess_data(X, y_flat, fit)
+        else:
+            X, segment_counts = self._extract_hashed_features(
+                examples, config, resources
+            )
+        groups = np.repeat(
+            np.arange(len(segment_counts), dtype=np.int32), segment_counts
+        )
+        # The first segment of each example is the one whose previous tag is the start tag
+        example_starts = np.cumsum(segment_counts) - segment_counts
+        example_starts = example_starts[segment_counts > 0]
+
+        if fit:
+            y, prev_tag_ids = self._fit_encode(y, example_starts)
+        else:
+            y = [tag for example in y for tag in example]
+            # Only the first segment of each example has a known previous tag
+            prev_tag_ids = np.full(len(groups), -1, dtype=np.int64)
+            prev_tag_ids[example_starts] = self._start_tag_id
+        X, y = self._preprocess_data(X, y, fit, prev_tag_ids)
         return X, y, groups
 
+    def _extract_hashed_features(self, examples, config, resources):
+        """Extracts and hashes the features of every segment of the examples.
+
+        Returns:
+            (tuple): tuple containing:
+
+                * (scipy.sparse.csr_matrix): The hashed features of each segment.
+                * (numpy.array): The number of segments in each example.
+        """
+        n_jobs = getattr(self, "_n_jobs", 1)
+        if n_jobs < 0:
+            n_jobs = max(joblib.cpu_count() + 1 + n_jobs, 1)
+        # Batch the examples so each worker call amortizes the cost of dispatching to it
+        batch_size = max(1, int(math.ceil(len(examples) / (4 * n_jobs))))
+        results = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_extract_batch_features)(
+                examples[start : start + batch_size],
+                config,
+                resources,
+                self.feat_vectorizer,
+            )
+            for start in range(0, len(examples), batch_size)
+        )
+        X = sp.vstack([X_batch for X_batch, _ in results], format="csr")
+        segment_counts = np.fromiter(
+            itertools.chain.from_iterable(counts for _, counts in results),
+            dtype=np.int64,
+        )
+        return X, segment_counts
+
+    def _extract_cached_features(self, examples, config, resources):
+        """Extracts and hashes the features of every segment of the examples like
+        _extract_hashed_features, reusing the features cached in the feature cache directory for
+        the same examples in any order.
+
+        The cache key covers everything the hashed features depend on: the examples, the feature
+        extractors, their code and settings, the resources and the hasher. The labels are not part
+        of it as they only enter the feature matrix after the cache.
+
+        Returns:
+            (tuple): tuple containing:
+
+                * (scipy.sparse.csr_matrix): The hashed features of each segment.
+                * (numpy.array): The number of segments in each example.
+        """
+        example_hashes = [joblib.hash(example) for example in examples]
+        key = joblib.hash(
+            (
+                sorted(example_hashes),
+                config.example_type,
+                self._get_feature_extractors_state(config),
+                resources,
+                self.feat_vectorizer.get_params(),
+            )
+        )
+        cache_dir = self._feature_cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, "memm_features_{}.pkl".format(key))
+
+        if not os.path.exists(cache_path):
+            X, segment_counts = self._extract_hashed_features(
+                examples, config, resources
+            )
+            # Write to a temporary file first so that the cache never holds a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            os.close(fd)
+            try:
+                joblib.dump((X, segment_counts, example_hashes), tmp_path)
+                os.replace(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            return X, segment_counts
+
+        X, segment_counts, cached_hashes = joblib.load(cache_path)
+        # Reorder the cached segments to follow the order of the examples
+        positions = dict(zip(cached_hashes, range(len(cached_hashes))))
+        order = np.array([positions[h] for h in example_hashes], dtype=np.int64)
+        cached_starts = np.cumsum(segment_counts) - segment_counts
+        segment_counts = segment_counts[order]
+        starts = np.cumsum(segment_counts) - segment_counts
+        rows = np.repeat(cached_starts[order] - starts, segment_counts) + np.arange(
+            segment_counts.sum()
+        )
+        return X[rows], segment_counts
+
+    @staticmethod
+    def _get_feature_extractors_state(config):
+        """Returns the settings and the compiled code of each feature extractor in the config, so
+        that editing a feature extractor invalidates the features cached for it.
+        """
+        state = []
+        for name, kwargs in sorted(config.features.items()):
+            if name == ENABLE_STEMMING:
+                state.append((name, kwargs, None))
+                continue
+            if callable(kwargs):
+                extractor, kwargs = kwargs, None
+            else:
+                extractor = get_feature_extractor(config.example_type, name)
+            code = getattr(extractor, "__code__", None)
+            state.append((name, kwargs, None if code is None else marshal.dumps(code)))
+        return state
+
+    def _fit_encode(self, y, example_starts):
+        """Fits the class encoder and encodes both the tag and the previous tag of every segment.
+
+        Args:
+            y (list of list of str): The tags of each example.
+            example_starts (numpy.array): The index of the first segment of each example.
+
+        Returns:
+            (tuple): tuple containing:
+
+                * (numpy.array): The encoded tag of each segment.
+                * (numpy.array): The encoded previous tag of each segment.
+        """
+        tags = np.array(list(itertools.chain.from_iterable(y)))
+        classes, tag_ids = np.unique(tags, return_inverse=True)
+        self.class_encoder.classes_ = classes
+        self._set_class_labels()
+        # The previous tag of a segment is the tag of the segment before it, except at the start
+        # of an example
+        prev_tag_ids = np.empty_like(tag_ids)
+        prev_tag_ids[1:] = tag_ids[:-1]
+        prev_tag_ids[example_starts] = self._start_tag_id
+        return tag_ids, prev_tag_ids
+
     def extract_and_predict(self, examples, config, resources):
         return [
             self._predict_example(example, config, resources) for example in examples
@@ -120,17 +353,62 @@ class MemmModel(Tagger):
         if len(features_by_segment) == 0:
             return []
 
-        predicted_tags = []
-        prev_tag = START_TAG
-        for features in features_by_segment:
-            features["prev_tag"] = prev_tag
-            X, _ = self._preprocess_data([features])
-            prediction = self.predict(X)
-            predicted_tag = self.class_encoder.inverse_transform(prediction)[0]
-            predicted_tags.append(predicted_tag)
-            prev_tag = predicted_tag
+        X, _ = self._preprocess_data(features_by_segment)
+        return list(self._class_labels[self._predict_tag_ids(X)])
+
+    def _predict_tag_ids(self, X):
+        """Predicts the encoded tags of a sequence from the features of its tokens, which exclude
+        the previous tag.
+
+        The model is log-linear, so the previous tag only adds a known column of weights to the
+        scores of each token. Every token is scored in one batch and the contribution of the
+        previous tag is added as the tags are decoded from left to right.
+        """
+        scores = self._get_class_scores(self._clf.decision_function(X))
+        return _decode(scores, self._get_prev_tag_scores(), self._start_tag_id)
+
+    def _get_prev_tag_features(self):
+        """Returns the preprocessed features of each possible previous tag.
+
+        Returns:
+            (scipy.sparse.csr_matrix): A matrix with one row per class, followed by a row for the \
+                start tag.
+        """
+        if getattr(self, "_feat_columns", None) is not None:
+            return self._project_features(
+                sp.identity(self._start_tag_id + 1, format="csr"),
+                self.feat_vectorizer.n_features,
+            )
+
+        # Models trained before the previous tag had its own columns hashed it as a feature
+        prev_tags = list(self.class_encoder.classes_) + [START_TAG]
+        X, _ = self._preprocess_data([{"prev_tag": tag} for tag in prev_tags])
+        return X
+
+    def _get_prev_tag_scores(self):
+        """Returns the contribution of each possible previous tag to the class scores.
+
+        Returns:
+            (numpy.ndarray): A matrix of shape (n_classes, n_classes + 1). Column i holds the \
+                scores added when the previous tag is the i-th class, and the last column holds \
+                the scores added when the previous tag is the start tag.
+        """
+        prev_tag_scores = getattr(self, "_prev_tag_scores", None)
+        if prev_tag_scores is None:
+            X = self._get_prev_tag_features()
+            prev_tag_scores = self._get_class_scores(X.dot(self._clf.coef_.T)).T
+            self._prev_tag_scores = prev_tag_scores
+        return prev_tag_scores
 
-        return predicted_tags
+    @staticmethod
+    def _get_class_scores(scores):
+        """Reshapes decision scores to one column per class. Binary classifiers only score the
+        positive class, so a zero column is prepended for the negative class.
+        """
+        scores = np.asarray(scores).reshape(len(scores), -1)
+        if scores.shape[1] == 1:
+            scores = np.hstack([np.zeros_like(scores), scores])
+        return scores
 
     def predict_proba(self, examples, config, resources):
         return [
@@ -143,28 +421,28 @@ class MemmModel(Tagger):
         if len(features_by_segment) == 0:
             return []
 
-        prev_tag = START_TAG
-        seq_log_probs = []
-        for features in features_by_segment:
-            features["prev_tag"] = prev_tag
-            X, _ = self._preprocess_data([features])
-            prediction = self._clf.predict_proba(X)[0]
-            predicted_tag = np.argmax(prediction)
-            prev_tag = self.class_encoder.inverse_transform(predicted_tag)
-            seq_log_probs.append([prev_tag, prediction[predicted_tag]])
-        return seq_log_probs
+        X, _ = self._preprocess_data(features_by_segment)
+        predicted_tag_ids = self._predict_tag_ids(X)
+        prev_tag_ids = np.concatenate([[self._start_tag_id], predicted_tag_ids[:-1]])
+        probas = self._clf.predict_proba(
+            X + self._get_prev_tag_features()[prev_tag_ids]
+        )
+        predicted_tags = self._class_labels[predicted_tag_ids]
+        return [
+            [tag, proba[tag_id]]
+            for tag, tag_id, proba in zip(predicted_tags, predicted_tag_ids, probas)
+        ]
 
     @staticmethod
     def _get_feature_selector(selector_type):
         """Get a feature selector instance based on the feature_selector model
-        parameter.
+        parameter. The 'l1' selector is not a separate model, see setup_model.
 
         Returns:
             (Object): A feature selector which returns a reduced feature matrix, \
                 given the full feature matrix, X and the class labels, y.
         """
         selector = {
-            "l1": SelectFromModel(LogisticRegression(penalty="l1", C=1)),
             "f": SelectPercentile(),
         }.get(selector_type)
         return selector
@@ -178,31 +456,148 @@ class MemmModel(Tagger):
         }.get(scale_type)
         return scaler
 
-    def setup_model(self, config):
+    def setup_model(self, config, cache_dir=None):
+        """Sets up the model for the given config.
+
+        Args:
+            config (ModelConfig): The model configuration.
+            cache_dir (str, optional): A directory to cache the extracted training features in, \
+                so that retraining on the same queries skips feature extraction. Defaults to the \
+                ``'feature_cache_dir'`` model setting; no features are cached when neither is set.
+
+        The ``'n_jobs'`` model setting extracts the training features in that many worker \
+        processes, which requires the custom feature extractors to be picklable, i.e. defined at \
+        the top level of a module rather than as local functions.
+        """
         if config.model_settings is None:
             selector_type = None
             scale_type = None
+            n_jobs = 1
         else:
             selector_type = config.model_settings.get("feature_selector")
             scale_type = config.model_settings.get("feature_scaler")
+            n_jobs = config.model_settings.get("n_jobs", 1)
+            cache_dir = cache_dir or config.model_settings.get("feature_cache_dir")
         self.class_encoder = SKLabelEncoder()
-        self.feat_vectorizer = DictVectorizer()
+        self.feat_vectorizer = FeatureHasher(
+            n_features=2 ** 20, input_type="dict", alternate_sign=False
+        )
         self._feat_selector = self._get_feature_selector(selector_type)
         self._feat_scaler = self._get_feature_scaler(scale_type)
+        # L1 feature selection is done by the classifier itself: an L1 penalty zeroes out the
+        # coefficients of the features it would have dropped, without fitting a second model
+        self._l1_feature_selection = selector_type == "l1"
+        params = self._clf.get_params()
+        if self._l1_feature_selection:
+            # set_params applies the L1 penalty, the current one was not chosen by the caller
+            del params["penalty"]
+        self.set_params(**params)
+        self._n_jobs = n_jobs
+        self._feature_cache_dir = cache_dir
+
+    def _preprocess_data(self, X, y=None, fit=False, prev_tag_ids=None):
+        """Vectorizes feature dicts and applies the feature scaling and selection.
+
+        Args:
+            X (iterable of dict or scipy.sparse.csr_matrix): The features of each segment, \
+                excluding the previous tag, either as dicts or already hashed.
+            y (numpy.array, optional): The encoded tags of each segment. Only used when fitting.
+            fit (bool): Whether to fit the preprocessing steps on this data.
+            prev_tag_ids (numpy.array, optional): The encoded previous tag of each segment, or \
+                -1 where it is unknown. When omitted, the features exclude the previous tag.
+
+        Returns:
+            (tuple): tuple containing:
 
-    def _preprocess_data(self, X, y=None, fit=False):
+                * (scipy.sparse.csr_matrix): The feature matrix, in the CSR layout expected by \
+                    the classifier's solvers.
+                * (numpy.array): The encoded tags.
+        """
+        if not sp.issparse(X):
+            X = self.feat_vectorizer.transform(X)
         if fit:
-            y = self.class_encoder.fit_transform(y)
-            X = self.feat_vectorizer.fit_transform(X)
+            # The previous tags get their own one-hot columns after the hashed features
+            X = sp.hstack([X, self._get_prev_tag_matrix(prev_tag_ids)], format="csr")
+            # Only keep the columns seen in training so that the model weights stay compact
+            columns = np.unique(X.indices)
+            X = X[:, columns]
             if self._feat_scaler is not None:
                 X = self._feat_scaler.fit_transform(X)
             if self._feat_selector is not None:
                 X = self._feat_selector.fit_transform(X, y)
+            self._set_feature_projection(columns)
         else:
-            X = self.feat_vectorizer.transform(X)
-            if self._feat_scaler is not None:
-                X = self._feat_scaler.transform(X)
-            if self._feat_selector is not None:
-                X = self._feat_selector.transform(X)
+            if getattr(self, "_feat_columns", None) is not None:
+                X = self._project_features(X)
+                if prev_tag_ids is not None:
+                    X = X + self._project_features(
+                        self._get_prev_tag_matrix(prev_tag_ids),
+                        self.feat_vectorizer.n_features,
+                    )
+            else:
+                if self._feat_scaler is not None:
+                    X = self._feat_scaler.transform(X)
+                if self._feat_selector is not None:
+                    X = self._feat_selector.transform(X)
 
         return X, y
+
+    def _get_prev_tag_matrix(self, prev_tag_ids):
+        """One-hot encodes the previous tag of each segment.
+
+        Args:
+            prev_tag_ids (numpy.array): The encoded previous tag of each segment, or -1 where it \
+                is unknown.
+
+        Returns:
+            (scipy.sparse.csr_matrix): A matrix with one column per class, followed by a column \
+                for the start tag.
+        """
+        rows = np.flatnonzero(prev_tag_ids >= 0)
+        return sp.csr_matrix(
+            (np.ones(len(rows)), (rows, prev_tag_ids[rows])),
+            shape=(len(prev_tag_ids), self._start_tag_id + 1),
+        )
+
+    def _set_feature_projection(self, columns):
+        """Fuses the columns kept in training with the fitted feature scaler and selector, so that
+        preprocessing at prediction time is a single lookup and scaling of the hashed features.
+        Only the kept columns and their scales are stored, which keeps the pickled model small.
+
+        Args:
+            columns (numpy.ndarray): The sorted columns of the hashed features and previous tags \
+                seen in training.
+        """
+        if self._feat_scaler is None:
+            scale = np.ones(len(columns))
+        else:
+            scale = 1.0 / self._feat_scaler.scale_
+        if self._feat_selector is not None:
+            support = self._feat_selector.get_support(indices=True)
+            columns = columns[support]
+            scale = scale[support]
+        self._feat_columns = columns
+        self._feat_scale = scale
+
+    def _project_features(self, X, offset=0):
+        """Keeps the columns of a feature matrix that were kept in training and scales them.
+
+        Args:
+            X (scipy.sparse.csr_matrix): The features, either hashed or previous tags.
+            offset (int): The column of the first feature of X among the hashed features and \
+                previous tags, i.e. the number of hashed features when X holds previous tags.
+
+        Returns:
+            (scipy.sparse.csr_matrix): The preprocessed features, one column per kept column.
+        """
+        columns = X.indices.astype(np.int64) + offset
+        positions = np.searchsorted(self._feat_columns, columns)
+        # Columns after the last kept one are compared against it and dropped
+        positions[positions == len(self._feat_columns)] = len(self._feat_columns) - 1
+        kept = self._feat_columns[positions] == columns
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        positions = positions[kept]
+        return sp.csr_matrix(
+            (X.data[kept] * self._feat_scale[positions], (rows[kept], positions)),
+            shape=(X.shape[0], len(self._feat_columns)),
+        )
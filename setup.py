@@ -24,7 +24,7 @@ requirements = [
     "python-dateutil~=2.6",
     "pytz",  # uses calendar versioning
     "scipy>=0.13.3,<2.0",
-    'scikit-learn>=0.18.1,<0.20; python_version < "3.7"',
+    'scikit-learn>=0.19,<0.20; python_version < "3.7"',
     'scikit-learn>=0.19.2,<0.20; python_version >= "3.7"',
     "requests>=2.20.1,<3.0",
     "tqdm~=4.15",
@@ -83,5 +83,6 @@ setup(
             'tensorflow~=1.2; python_version < "3.7"',
             'tensorflow>=1.13.1,<2.0; python_version >= "3.7"',
         ],
+        "numba": ["numba>=0.38"],
     },
 )
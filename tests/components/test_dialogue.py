@@ -108,6 +108,24 @@ def test_dialogue_state_rule_targeted_only():
     assert msg in str(ex.value)
 
 
+def test_dialogue_state_rule_entities():
+    rule = DialogueStateRule(
+        dialogue_state="some-state", has_entities=["entity_1", "entity_2"]
+    )
+    assert rule.apply(
+        create_request(
+            "domain",
+            "intent",
+            [{"type": "entity_2"}, {"type": "unused_entity"}, {"type": "entity_1"}],
+        )
+    )
+    assert not rule.apply(create_request("domain", "intent", [{"type": "entity_1"}]))
+
+    entity_mask = DialogueStateRule.get_entity_mask(["entity_1", "entity_2"])
+    assert entity_mask == rule.entity_mask
+    assert rule.apply(create_request("domain", "intent"), entity_mask)
+
+
 def test_dialogue_state_rule_exception():
     with pytest.raises(ValueError):
         DialogueStateRule(dialogue_state="some-state", has_entities=[1, 2])
@@ -276,6 +294,26 @@ class TestDialogueManager:
         result = dm.apply_handler(request, response)
         assert result.dialogue_state == "middleware_test"
 
+    def test_middleware_added_after_apply(self, dm):
+        """Middleware added after a dialogue state was handled applies to it"""
+
+        def _middle(request, responder, handler):
+            responder.flag = True
+            handler(request, responder)
+
+        def _handler(request, responder):
+            responder.handled = vars(responder).get("flag", False)
+
+        dm.add_dialogue_rule("middleware_test", _handler, intent="middle")
+
+        request = create_request("domain", "middle")
+        response = dm.apply_handler(request, create_responder(request))
+        assert not response.handled
+
+        dm.add_middleware(_middle)
+        response = dm.apply_handler(request, create_responder(request))
+        assert response.handled
+
 
 def test_convo_params_are_cleared(kwik_e_mart_nlp, kwik_e_mart_app_path):
     """Tests that the params are cleared in one trip from app to mm."""
@@ -8,9 +8,23 @@ test_tagger
 Tests for `tagger` module.
 """
 # pylint: disable=locally-disabled,redefined-outer-name
+import os
+import pickle
+import random
+
+import numpy as np
 import pytest
+from sklearn.feature_extraction import DictVectorizer
 
+from mindmeld import markup
+from mindmeld.models import ModelConfig
+from mindmeld.models.tagger_models import TaggerModel
 from mindmeld.models.taggers import taggers
+from mindmeld.models.taggers.memm import MemmModel
+from mindmeld.models.taggers.taggers import START_TAG
+from mindmeld.query_factory import QueryFactory
+from mindmeld.stemmers import EnglishNLTKStemmer
+from mindmeld.tokenizer import Tokenizer
 
 # This index is the start index of when the time section of the full time format. For example:
 # 2013-02-12T11:30:00.000-02:00, index 8 onwards slices 11:30:00.000-02:00 from the full time
@@ -364,3 +378,250 @@ def test_lstm_er_model(kwik_e_mart_nlp):
     er.fit(**config)
     response = kwik_e_mart_nlp.process("Does the 156th location open on Saturday?")
     assert response["entities"][0]["value"][0]["cname"] == "156th Street"
+
+
+MEMM_TRAINING_DATA = [
+    ("when does the main st store open", "O| O| O| B|store_name I|store_name O| O|"),
+    ("is the elm street store open today", "O| O| B|store_name I|store_name O| O| O|"),
+    ("hours for bay view", "O| O| B|store_name I|store_name"),
+    ("what time does pine close", "O| O| O| B|store_name O|"),
+    ("store hours for main st please", "O| O| O| B|store_name I|store_name O|"),
+    ("when is elm open", "O| O| B|store_name O|"),
+    ("open hours", "O| O|"),
+    ("is bay view store open on sunday", "O| B|store_name I|store_name O| O| O| O|"),
+]
+
+
+@pytest.fixture
+def memm_queries():
+    """Queries and their tags for training an MEMM without an app"""
+    query_factory = QueryFactory(Tokenizer(), stemmer=EnglishNLTKStemmer())
+    queries = [query_factory.create_query(text) for text, _ in MEMM_TRAINING_DATA]
+    tags = [tags.split() for _, tags in MEMM_TRAINING_DATA]
+    return queries, tags
+
+
+@pytest.fixture
+def memm_config():
+    return ModelConfig(
+        model_type="tagger",
+        example_type="query",
+        label_type="entities",
+        model_settings={
+            "classifier_type": "memm",
+            "tag_scheme": "IOB",
+            "feature_scaler": "max-abs",
+        },
+        params={"C": 100},
+        features={
+            "bag-of-words-seq": {"ngram_lengths_to_start_positions": {1: [-1, 0, 1]}}
+        },
+    )
+
+
+@pytest.fixture
+def memm_resources():
+    return {"w_ngram_freq": {}}
+
+
+def _fit_memm(queries, tags, config, resources):
+    model = MemmModel()
+    model.setup_model(config)
+    X, y, _ = model.extract_features(queries, config, resources, tags)
+    model.set_params(**config.params)
+    return model.fit(X, y)
+
+
+def _predict_memm_per_token(model, query, config, resources):
+    """Predicts the tags of a query one token at a time, with the previous tag as a feature"""
+    features = model.extract_example_features(query, config, resources)
+    tag_ids, probas = [], []
+    prev_tag_id = model._start_tag_id
+    for segment in features:
+        X, _ = model._preprocess_data([segment], prev_tag_ids=np.array([prev_tag_id]))
+        prev_tag_id = model._clf.predict(X)[0]
+        tag_ids.append(prev_tag_id)
+        probas.append(model._clf.predict_proba(X)[0][prev_tag_id])
+    return list(model.class_encoder.inverse_transform(tag_ids)), probas
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_memm_predict(memm_queries, memm_config, memm_resources, binary):
+    """Scoring all tokens at once predicts the same tags as scoring them one at a time"""
+    queries, tags = memm_queries
+    if binary:
+        tags = [[tag.replace("I|", "B|") for tag in example] for example in tags]
+    model = _fit_memm(queries, tags, memm_config, memm_resources)
+    assert len(model.class_encoder.classes_) == (2 if binary else 3)
+
+    predicted = model.extract_and_predict(queries, memm_config, memm_resources)
+    for query, query_tags in zip(queries, predicted):
+        expected, _ = _predict_memm_per_token(model, query, memm_config, memm_resources)
+        assert query_tags == expected
+
+
+def test_memm_predict_proba(memm_queries, memm_config, memm_resources):
+    queries, tags = memm_queries
+    model = _fit_memm(queries, tags, memm_config, memm_resources)
+
+    predicted = model.predict_proba(queries, memm_config, memm_resources)
+    for query, query_probas in zip(queries, predicted):
+        expected_tags, expected_probas = _predict_memm_per_token(
+            model, query, memm_config, memm_resources
+        )
+        assert [tag for tag, _ in query_probas] == expected_tags
+        assert np.allclose([proba for _, proba in query_probas], expected_probas)
+
+
+def test_memm_unpickle_old_model(memm_queries, memm_config, memm_resources):
+    """Models pickled before the class labels and feature projection were stored, which
+    vectorized the previous tag as a feature, still predict"""
+    queries, tags = memm_queries
+    model = MemmModel(**memm_config.params)
+    model.setup_model(memm_config)
+    features, labels = [], []
+    for query, query_tags in zip(queries, tags):
+        prev_tag = START_TAG
+        for segment, tag in zip(
+            model.extract_example_features(query, memm_config, memm_resources),
+            query_tags,
+        ):
+            features.append(dict(segment, prev_tag=prev_tag))
+            labels.append(tag)
+            prev_tag = tag
+    model.feat_vectorizer = DictVectorizer()
+    model._feat_scaler = None
+    model._clf.fit(
+        model.feat_vectorizer.fit_transform(features),
+        model.class_encoder.fit_transform(labels),
+    )
+    assert not hasattr(model, "_class_labels")
+    assert not hasattr(model, "_feat_columns")
+
+    model = pickle.loads(pickle.dumps(model))
+    predicted = model.extract_and_predict(queries, memm_config, memm_resources)
+    for query, query_tags in zip(queries, predicted):
+        expected = []
+        prev_tag = START_TAG
+        for segment in model.extract_example_features(
+            query, memm_config, memm_resources
+        ):
+            X = model.feat_vectorizer.transform([dict(segment, prev_tag=prev_tag)])
+            prev_tag = model.class_encoder.inverse_transform(model._clf.predict(X))[0]
+            expected.append(prev_tag)
+        assert query_tags == expected
+
+
+def test_memm_l1_feature_selection_cv(mocker, memm_resources):
+    """Cross-validation candidates are trained with the L1 penalty of the 'l1' feature selector"""
+    query_factory = QueryFactory(Tokenizer(), stemmer=EnglishNLTKStemmer())
+    queries = [
+        markup.load_query(text, query_factory=query_factory)
+        for text in [
+            "when does the {main st|store_name} store open",
+            "is the {elm street|store_name} store open today",
+            "hours for {bay view|store_name}",
+            "what time does {pine|store_name} close",
+            "store hours for {main st|store_name} please",
+            "when is {elm|store_name} open",
+        ]
+    ]
+    config = ModelConfig(
+        model_type="tagger",
+        example_type="query",
+        label_type="entities",
+        model_settings={
+            "classifier_type": "memm",
+            "tag_scheme": "IOB",
+            "feature_selector": "l1",
+        },
+        param_selection={
+            "type": "k-fold",
+            "k": 2,
+            "n_jobs": 1,
+            "grid": {"penalty": ["l1", "l2"], "C": [1, 100]},
+        },
+        features={
+            "bag-of-words-seq": {"ngram_lengths_to_start_positions": {1: [-1, 0, 1]}}
+        },
+    )
+    model = TaggerModel(config)
+    model.register_resources(**memm_resources)
+    fit_spy = mocker.spy(MemmModel, "fit")
+    model.fit([q.query for q in queries], [q.entities for q in queries])
+
+    # 2 folds for each of the 2 values of C, the refit of the best candidate and the final fit
+    assert fit_spy.call_count == 6
+    assert all(call[0][0]._clf.penalty == "l1" for call in fit_spy.call_args_list)
+    assert model._clf._clf.penalty == "l1"
+
+
+def test_memm_feature_cache(tmpdir, memm_queries, memm_config, memm_resources):
+    """Cached features are reused for the same queries in any order"""
+    queries, tags = memm_queries
+    cache_dir = str(tmpdir)
+    for seed in range(3):
+        indices = list(range(len(queries)))
+        random.Random(seed).shuffle(indices)
+        examples = [queries[i] for i in indices]
+        labels = [tags[i] for i in indices]
+
+        model = MemmModel()
+        model.setup_model(memm_config)
+        expected = model.extract_features(examples, memm_config, memm_resources, labels)
+
+        model = MemmModel()
+        model.setup_model(memm_config, cache_dir=cache_dir)
+        cached = model.extract_features(examples, memm_config, memm_resources, labels)
+
+        assert (cached[0] != expected[0]).nnz == 0
+        assert np.array_equal(cached[1], expected[1])
+        assert np.array_equal(cached[2], expected[2])
+        assert len(os.listdir(cache_dir)) == 1
+
+
+def test_memm_feature_cache_extractor_code(tmpdir, memm_queries, memm_resources):
+    """Changing the code of a feature extractor does not reuse the cached features"""
+    queries, tags = memm_queries
+
+    def _first_extractor(query, resources):
+        return [{"token": token} for token in query.normalized_tokens]
+
+    def _second_extractor(query, resources):
+        return [{"token": token.upper()} for token in query.normalized_tokens]
+
+    for extractor in (_first_extractor, _second_extractor):
+        config = ModelConfig(
+            model_type="tagger",
+            example_type="query",
+            label_type="entities",
+            model_settings={"classifier_type": "memm", "tag_scheme": "IOB"},
+            params={"C": 100},
+            features={"custom": extractor},
+        )
+        model = MemmModel()
+        model.setup_model(config, cache_dir=str(tmpdir))
+        model.extract_features(queries, config, memm_resources, tags)
+
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_memm_extract_features_n_jobs(memm_queries, memm_config, memm_resources):
+    """Extracting features in worker processes gives the same features as in this process"""
+    queries, tags = memm_queries
+    extracted = []
+    for n_jobs in (1, 2):
+        config = ModelConfig(
+            **dict(
+                memm_config.to_dict(),
+                model_settings=dict(memm_config.model_settings, n_jobs=n_jobs),
+            )
+        )
+        model = MemmModel()
+        model.setup_model(config)
+        extracted.append(model.extract_features(queries, config, memm_resources, tags))
+
+    (X, y, groups), (X_parallel, y_parallel, groups_parallel) = extracted
+    assert (X_parallel != X).nnz == 0
+    assert np.array_equal(y_parallel, y)
+    assert np.array_equal(groups_parallel, groups)